@@ -1,8 +1,22 @@
+from __future__ import annotations
+
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-from instagrapi import Client
-from groq import Groq
+
+# instagrapi, groq, httpx and requests are heavy to import, so they are imported inside
+# the functions that use them; the landing page renders without paying for any of them.
+if TYPE_CHECKING:
+    from instagrapi import Client
+    from groq import Groq
 
 # -----------------------------------------------------------------------------
 # Load environment variables
@@ -27,67 +41,325 @@ if not groq_api_key:
 IG_USERNAME = st.secrets.get("instagram", {}).get("username", None)
 IG_PASSWORD = st.secrets.get("instagram", {}).get("password", None)
 
+# Where the instagrapi session (cookies, device uuids) is persisted between runs
+IG_SESSION_FILE = "session.json"
+
+# Public web endpoint used by instagram.com itself to render profile pages
+IG_WEB_PROFILE_URL = "https://www.instagram.com/api/v1/users/web_profile_info/"
+IG_WEB_APP_ID = "936619743392459"
+# The web endpoint rejects non-browser user agents ("useragent mismatch")
+IG_WEB_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+)
+
 
 st.write("Secrets loaded successfully! (But not displaying them for security reasons.)")
 
 
+# -----------------------------------------------------------------------------
+# Post record shared by the fetchers and the UI
+# -----------------------------------------------------------------------------
+@dataclass(slots=True, frozen=True)
+class Post:
+    """
+    Metadata of a single Instagram post, as displayed in the UI.
+    """
+    pk: str
+    caption: str
+    like_count: int
+    comment_count: int
+    taken_at: datetime
+    image_url: str
+
+
 # -----------------------------------------------------------------------------
 # Login to Instagram with instagrapi
 # -----------------------------------------------------------------------------
+@st.cache_resource(show_spinner=False)
 def login_instagram() -> Client:
     """
     Logs into Instagram using instagrapi and returns the authenticated client.
+    The client is cached so we don't re-authenticate on every rerun, and the
+    session settings are saved to IG_SESSION_FILE so a restart can replay the
+    existing cookies instead of doing the full login handshake again.
     """
+    from instagrapi import Client
+    from instagrapi.exceptions import LoginRequired
+
     if not IG_USERNAME or not IG_PASSWORD:
         raise ValueError("Instagram credentials not found in environment variables.")
     
     cl = Client()
+    if os.path.exists(IG_SESSION_FILE):
+        cl.load_settings(IG_SESSION_FILE)
+        try:
+            cl.login(IG_USERNAME, IG_PASSWORD, relogin=False)
+            # Cheap authenticated call to make sure the saved session is still valid
+            cl.get_timeline_feed()
+            return cl
+        except LoginRequired:
+            # Session expired: keep the same device uuids but drop the stale cookies
+            old_settings = cl.get_settings()
+            cl.set_settings({})
+            cl.set_uuids(old_settings["uuids"])
+
     cl.login(IG_USERNAME, IG_PASSWORD)
+    cl.dump_settings(IG_SESSION_FILE)
     return cl
 
+@st.cache_resource(show_spinner=False)
+def public_instagram_client() -> Client:
+    """
+    Returns an anonymous instagrapi client for the public GraphQL endpoints (no login needed).
+    """
+    from instagrapi import Client
+
+    return Client()
+
 # -----------------------------------------------------------------------------
 # Fetch Instagram posts (with images) using instagrapi
 # -----------------------------------------------------------------------------
-def fetch_user_posts(username: str, count: int = 5):
+def _retry(fn, *args, retry_on: tuple = None, retries: int = 3, base: float = 6.5):
     """
-    Fetch the last 'count' posts of the specified Instagram user.
-    Returns a list of dictionaries containing post metadata, including image URLs.
+    Calls fn(*args), retrying with exponential backoff plus jitter when Instagram throttles us.
+    retry_on lists the exceptions that mean "throttled"; it defaults to instagrapi's
+    ClientThrottledError (429) and PleaseWaitFewMinutes.
+    Re-raises the throttling error once all retries are used up.
+    """
+    if retry_on is None:
+        from instagrapi.exceptions import ClientThrottledError, PleaseWaitFewMinutes
+
+        retry_on = (ClientThrottledError, PleaseWaitFewMinutes)
+
+    for attempt in range(retries):
+        try:
+            return fn(*args)
+        except retry_on:
+            if attempt == retries - 1:
+                raise
+            time.sleep(base * (2 ** attempt) + random.random() * 2)
+
+
+@st.cache_data(ttl=3600, max_entries=200, show_spinner=False)
+def _fetch_thumb(url: str) -> bytes:
+    """
+    Downloads a thumbnail from the Instagram CDN. Cached so reruns don't re-download it;
+    failures raise and are not cached, so the download is retried on the next render.
+    """
+    import requests
+
+    response = requests.get(url, timeout=5)
+    response.raise_for_status()
+    return response.content
+
+
+@st.cache_data(ttl=60, max_entries=200, show_spinner=False)
+def _thumb_or_none(url: str):
+    """
+    Returns the thumbnail bytes, or None if the download failed. Failures are kept out of
+    _fetch_thumb's long-lived cache, but remembered here for a minute so a broken URL
+    isn't requested again on every rerun.
+    """
+    import requests
+
+    try:
+        return _fetch_thumb(url)
+    except requests.RequestException:
+        return None
+
+
+def _extract_post(media) -> Post:
+    """
+    Converts a single instagrapi Media object into the Post used by the UI.
+    """
+    # Convert the HttpUrl / any link to a raw string
+    image_url = ""
+    if hasattr(media, 'thumbnail_url') and media.thumbnail_url:
+        image_url = str(media.thumbnail_url)
+    elif hasattr(media, 'resources') and len(media.resources) > 0:
+        # Possibly a carousel post; pick first resource's thumbnail_url
+        image_url = str(media.resources[0].thumbnail_url)
+
+    return Post(
+        pk=str(media.pk),
+        caption=media.caption_text,
+        like_count=media.like_count,
+        comment_count=media.comment_count,
+        taken_at=media.taken_at,
+        image_url=image_url,
+    )
+
+
+class PublicProfileUnavailable(Exception):
+    """
+    Raised when Instagram's public web endpoint can't serve the requested posts
+    (login required, unexpected payload, or not enough posts embedded).
+    """
+
+
+def _get_web_profile(username: str):
+    """
+    Requests the public web profile payload. Raises httpx.HTTPStatusError only on 429,
+    so _retry can back off; any other response is returned for the caller to inspect.
+    """
+    import httpx
+
+    response = httpx.get(
+        IG_WEB_PROFILE_URL,
+        params={"username": username},
+        headers={"x-ig-app-id": IG_WEB_APP_ID, "User-Agent": IG_WEB_USER_AGENT},
+        timeout=10.0,
+    )
+    if response.status_code == 429:
+        response.raise_for_status()
+    return response
+
+
+def fetch_user_posts_public(username: str, count: int = 5):
+    """
+    Fetch the last 'count' posts of a public profile with a single request to Instagram's
+    web profile endpoint (no login, no request signing).
+    Raises PublicProfileUnavailable if the endpoint can't be used for this profile (login
+    required, any 4xx other than 429, private profile), and httpx.HTTPStatusError for
+    throttling (429) and server errors.
+    """
+    import httpx
+
+    response = _retry(_get_web_profile, username, retry_on=(httpx.HTTPStatusError,))
+    if response.is_redirect or 400 <= response.status_code < 500:
+        # Instagram wants us to log in (usually a redirect to the login page) or refused the request
+        raise PublicProfileUnavailable(f"Public endpoint refused the request (HTTP {response.status_code}).")
+    response.raise_for_status()
+
+    try:
+        user = response.json()["data"]["user"]
+        timeline = user["edge_owner_to_timeline_media"]
+        edges = timeline["edges"][:count]
+        has_next_page = timeline["page_info"]["has_next_page"]
+        # Private profiles come back with a post count but no edges
+        if user.get("is_private") or (not edges and timeline["count"] > 0):
+            raise PublicProfileUnavailable("Profile is private; its posts need a logged-in client.")
+
+        posts_data = []
+        for edge in edges:
+            node = edge["node"]
+            caption_edges = node["edge_media_to_caption"]["edges"]
+            posts_data.append(Post(
+                pk=node["id"],
+                caption=caption_edges[0]["node"]["text"] if caption_edges else "",
+                like_count=node["edge_liked_by"]["count"],
+                comment_count=node["edge_media_to_comment"]["count"],
+                taken_at=datetime.fromtimestamp(node["taken_at_timestamp"], tz=timezone.utc),
+                image_url=node.get("thumbnail_src") or node.get("display_url") or "",
+            ))
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise PublicProfileUnavailable(f"Unexpected public endpoint payload: {e!r}") from e
+
+    # The profile page only embeds the first few posts; let instagrapi page through the rest
+    if len(posts_data) < count and has_next_page:
+        raise PublicProfileUnavailable(f"Public endpoint returned only {len(posts_data)} of {count} posts.")
+    return posts_data
+
+
+def _private_user_medias(username: str, count: int):
+    """
+    Fetch the user's medias through the authenticated private API.
     """
     cl = login_instagram()
-    user_id = cl.user_id_from_username(username)
-    medias = cl.user_medias(user_id, count)
-
-    posts_data = []
-    for media in medias:
-        # Convert the HttpUrl / any link to a raw string
-        image_url = ""
-        if hasattr(media, 'thumbnail_url') and media.thumbnail_url:
-            image_url = str(media.thumbnail_url)
-        elif hasattr(media, 'resources') and len(media.resources) > 0:
-            # Possibly a carousel post; pick first resource's thumbnail_url
-            image_url = str(media.resources[0].thumbnail_url)
-
-        posts_data.append({
-            "pk": media.pk,
-            "caption": media.caption_text,
-            "like_count": media.like_count,
-            "comment_count": media.comment_count,
-            "taken_at": media.taken_at,
-            "image_url": image_url,
-        })
+    user_id = _retry(cl.user_id_from_username, username)
+    return _retry(cl.user_medias, user_id, count)
+
+
+def _fetch_user_posts_instagrapi(username: str, count: int = 5):
+    """
+    Fetch the last 'count' posts of the specified Instagram user through instagrapi.
+    """
+    from instagrapi.exceptions import ClientError, ClientThrottledError, LoginRequired
+
+    try:
+        # Public profiles can be read through the GraphQL endpoints without spending
+        # the logged-in account's private API budget. instagrapi's public transport
+        # already retries 429s, so these calls are not wrapped in _retry.
+        cl = public_instagram_client()
+        user = cl.user_info_by_username_gql(username)
+        medias = cl.user_medias_gql(user.pk, count)
+    except ClientThrottledError:
+        # Throttled: surface it instead of moving on to the even more rate-limited private API
+        raise
+    except ClientError:
+        # Private profile or GraphQL refused the request: fall back to the authenticated API
+        try:
+            medias = _private_user_medias(username, count)
+        except LoginRequired:
+            # The cached client's session expired after login: drop it and log in again once
+            login_instagram.clear()
+            medias = _private_user_medias(username, count)
+
+    return [_extract_post(media) for media in medias]
+
+
+def _fetch_user_posts_uncached(username: str, count: int = 5):
+    """
+    Fetch the last 'count' posts of the specified Instagram user.
+    Returns a list of Post records containing post metadata, including image URLs.
+    """
+    try:
+        posts_data = fetch_user_posts_public(username, count)
+    except PublicProfileUnavailable:
+        # Public endpoint wants a login, changed shape, or didn't have enough posts
+        posts_data = _fetch_user_posts_instagrapi(username, count)
+
+    # Download all thumbnails up front so the first render is served from cache.
+    # The workers need this script run's context, otherwise st.cache_data can't store results.
+    image_urls = [post.image_url for post in posts_data if post.image_url]
+    if image_urls:
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=min(8, len(image_urls)),
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+        ) as executor:
+            list(executor.map(_thumb_or_none, image_urls))
     return posts_data
 
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_user_posts(username: str, count: int = 5):
+    """
+    Cached wrapper around _fetch_user_posts_uncached, keyed on (username, count).
+    Repeated fetches within 5 minutes are served from memory instead of hitting Instagram.
+    """
+    return _fetch_user_posts_uncached(username, count)
+
 # -----------------------------------------------------------------------------
 # Use groq to generate a new post in the same style as a selected Instagram post
 # -----------------------------------------------------------------------------
-def generate_post_in_same_style(post_caption: str) -> str:
+GROQ_MODEL = "llama-3.3-70b-versatile"
+GROQ_TEMPERATURE = 0.6
+GROQ_TOP_P = 0.95
+# A short caption + a few hashtags + a posting time fits comfortably in 256 tokens
+GROQ_MAX_COMPLETION_TOKENS = 256
+GROQ_STOP = ["\n\n\n"]
+# How long (in seconds) a generated post is reused for the same caption and model settings
+GENERATED_POST_TTL = 600
+
+
+@st.cache_resource(show_spinner=False)
+def _groq_client() -> Groq:
     """
-    Calls the groq API to generate a new post in the same style as the provided caption.
+    Returns a shared groq client so its HTTP connection pool is reused across calls and reruns.
     """
-    client = Groq()
+    from groq import Groq
+
+    return Groq(api_key=groq_api_key)
 
+
+def _build_style_messages(post_caption: str) -> list:
+    """
+    Builds the chat messages asking the model to write a post in the style of the given caption.
+    """
     # We'll create a system instruction and user prompt referencing the caption
-    messages = [
+    return [
         {
             "role": "system",
             "content": (
@@ -102,33 +374,170 @@ def generate_post_in_same_style(post_caption: str) -> str:
         }
     ]
 
+
+def generate_post_in_same_style(post_caption: str):
+    """
+    Calls the groq API to generate a new post in the same style as the provided caption.
+    Yields the text chunk by chunk as it is streamed back, so it can be passed to st.write_stream.
+    """
+    client = _groq_client()
+
     completion = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=messages,
-        temperature=0.6,
-        max_completion_tokens=4096,
-        top_p=0.95,
+        model=GROQ_MODEL,
+        messages=_build_style_messages(post_caption),
+        temperature=GROQ_TEMPERATURE,
+        max_completion_tokens=GROQ_MAX_COMPLETION_TOKENS,
+        top_p=GROQ_TOP_P,
         stream=True,
-        stop=None,
+        stop=GROQ_STOP,
     )
 
-    final_text = ""
     for chunk in completion:
         piece = chunk.choices[0].delta.content
         if piece:
-            final_text += piece
+            yield piece
+
+
+def generate_post_text_in_same_style(post_caption: str) -> str:
+    """
+    Non-streaming variant of generate_post_in_same_style that returns the full generated text.
+    """
+    # Collect the pieces in a list and join once, rather than re-building the string per chunk
+    parts = list(generate_post_in_same_style(post_caption))
+    return "".join(parts).strip()
 
-    return final_text.strip()
+
+@st.cache_resource(show_spinner=False)
+def _generated_posts_store() -> tuple:
+    """
+    Process-wide (lock, {key: (timestamp, text)}) store of generated posts, shared by all sessions.
+    st.cache_data can't be filled from a streamed response, so the TTL is handled by hand.
+    """
+    return threading.Lock(), {}
+
+
+def _cached_generated_post(key: tuple):
+    """
+    Returns the text previously generated for key (in any session), or None if there is
+    none or it is older than GENERATED_POST_TTL seconds. Expired entries are dropped.
+    """
+    lock, generated_posts = _generated_posts_store()
+    now = time.time()
+    with lock:
+        for expired_key in [k for k, (ts, _) in generated_posts.items() if now - ts >= GENERATED_POST_TTL]:
+            del generated_posts[expired_key]
+        entry = generated_posts.get(key)
+    return entry[1] if entry else None
+
+
+def _remember_generated_post(key: tuple, text: str):
+    """
+    Stores a freshly generated post so identical requests reuse it for GENERATED_POST_TTL seconds.
+    """
+    lock, generated_posts = _generated_posts_store()
+    with lock:
+        generated_posts[key] = (time.time(), text)
 
 # -----------------------------------------------------------------------------
 # Main Streamlit App
 # -----------------------------------------------------------------------------
+def store_fetched_posts(fetched_posts: list):
+    """
+    Saves the fetched posts in session_state along with the radio labels derived from them,
+    so the labels are built once per fetch rather than on every rerun.
+    """
+    labels = tuple(
+        f"Post #{i} | Likes: {p.like_count} | Comments: {p.comment_count}"
+        for i, p in enumerate(fetched_posts, start=1)
+    )
+    st.session_state.fetched_posts = fetched_posts
+    st.session_state.post_labels = labels
+    st.session_state.pk_by_label = {lbl: p.pk for lbl, p in zip(labels, fetched_posts)}
+    st.session_state.label_by_pk = {p.pk: lbl for lbl, p in zip(labels, fetched_posts)}
+    st.session_state.label_index = {lbl: i for i, lbl in enumerate(labels)}
+    st.session_state.post_by_pk = {p.pk: p for p in fetched_posts}
+
+
+@st.fragment
+def post_selector():
+    """
+    Post selection, details and generation. Runs as a fragment so picking a different
+    post only reruns this block instead of the whole script.
+    """
+    st.subheader("Select a post to replicate its style")
+
+    # Labels and the label->pk mapping are precomputed in store_fetched_posts
+    post_labels = st.session_state.post_labels
+    pk_by_label = st.session_state.pk_by_label
+
+    # Label matching st.session_state.selected_post_pk; if no item is selected yet,
+    # pick the first one as a default
+    current_label = st.session_state.label_by_pk.get(st.session_state.selected_post_pk, post_labels[0])
+
+    # A radio with the current selection => 
+    selected_label = st.radio(
+        "Pick a post's style to replicate",
+        options=post_labels,
+        index=st.session_state.label_index[current_label],
+        key="selected_label_radio",
+    )
+
+    # Every time the user picks a new label, we update session_state.selected_post_pk
+    st.session_state.selected_post_pk = pk_by_label[selected_label]
+
+    # Find the corresponding post data for the selection
+    selected_post_data = st.session_state.post_by_pk.get(st.session_state.selected_post_pk)
+
+    # Show details with an image on the left (or fallback to just URL if there's an error)
+    if selected_post_data:
+        with st.container():
+            col1, col2 = st.columns([1, 3])
+            with col1:
+                if selected_post_data.image_url:
+                    thumb = _thumb_or_none(selected_post_data.image_url)
+                    image_shown = False
+                    if thumb is not None:
+                        try:
+                            st.image(thumb, use_column_width=True)
+                            image_shown = True
+                        except Exception:
+                            # Downloaded, but the response isn't a displayable image
+                            pass
+                    if not image_shown:
+                        # If the image couldn't be downloaded or displayed, show the raw URL
+                        st.write("Unable to display the image. Here's the URL:")
+                        st.write(selected_post_data.image_url)
+                else:
+                    st.write("No image available.")
+
+            with col2:
+                st.write(f"**Caption:** {selected_post_data.caption}")
+                st.write(f"**Date:** {selected_post_data.taken_at}")
+                st.write(f"**Likes:** {selected_post_data.like_count} | **Comments:** {selected_post_data.comment_count}")
+
+        # Button to generate a similar-style post
+        if st.button("Generate Post In Similar Style"):
+            caption = selected_post_data.caption
+            key = (caption, GROQ_MODEL, GROQ_TEMPERATURE, GROQ_TOP_P, GROQ_MAX_COMPLETION_TOKENS)
+            st.success("AI-Generated Post")
+            ai_generated = _cached_generated_post(key)
+            if ai_generated is not None:
+                # Generated recently with the same settings: reuse it instead of paying for another groq call
+                st.write(ai_generated)
+            else:
+                # Render the text as it streams in instead of waiting for the full completion
+                ai_generated = st.write_stream(generate_post_in_same_style(caption)).strip()
+                _remember_generated_post(key, ai_generated)
+    else:
+        st.warning("No post selected yet.")
+
+
 def main():
     st.title("Instagram Post Style Generator")
 
     # Make sure we have a place in session_state for certain variables
     if "fetched_posts" not in st.session_state:
-        st.session_state.fetched_posts = []
+        store_fetched_posts([])
     if "selected_post_pk" not in st.session_state:
         st.session_state.selected_post_pk = None
 
@@ -144,84 +553,17 @@ def main():
                 fetched_posts = fetch_user_posts(username, num_posts)
             if not fetched_posts:
                 st.sidebar.warning("No posts found or an error occurred.")
-                st.session_state.fetched_posts = []
+                store_fetched_posts([])
             else:
-                st.session_state.fetched_posts = fetched_posts
+                store_fetched_posts(fetched_posts)
                 st.sidebar.success(f"Fetched {len(fetched_posts)} posts.")
         except Exception as e:
             st.sidebar.error(f"Could not fetch posts. Reason: {e}")
-            st.session_state.fetched_posts = []
+            store_fetched_posts([])
 
     # Now display the posts from session_state (if any)
     if st.session_state.fetched_posts:
-        st.subheader("Select a post to replicate its style")
-
-        # We'll build the post options with labels and store them in a list
-        post_options = []
-        for i, post in enumerate(st.session_state.fetched_posts, start=1):
-            # We'll build a label for the radio button
-            label = f"Post #{i} | Likes: {post['like_count']} | Comments: {post['comment_count']}"
-            post_options.append((label, post["pk"]))
-
-        # Convert (label->pk) to a dict so we can retrieve the pk from the selected label
-        post_label_to_pk = {label: pk for (label, pk) in post_options}
-
-        # If no item is selected yet, pick the first one as a default
-        default_label = list(post_label_to_pk.keys())[0]
-        # Current label if we have a saved pk
-        current_label = default_label
-        # Find label matching st.session_state.selected_post_pk
-        for lbl, pk in post_label_to_pk.items():
-            if pk == st.session_state.selected_post_pk:
-                current_label = lbl
-                break
-
-        # A radio with the current selection => 
-        selected_label = st.radio(
-            "Pick a post's style to replicate",
-            options=list(post_label_to_pk.keys()),
-            index=list(post_label_to_pk.keys()).index(current_label),
-            key="selected_label_radio",
-        )
-
-        # Every time the user picks a new label, we update session_state.selected_post_pk
-        st.session_state.selected_post_pk = post_label_to_pk[selected_label]
-
-        # Find the corresponding post data for the selection
-        selected_post_data = next(
-            (p for p in st.session_state.fetched_posts if p["pk"] == st.session_state.selected_post_pk),
-            None
-        )
-
-        # Show details with an image on the left (or fallback to just URL if there's an error)
-        if selected_post_data:
-            with st.container():
-                col1, col2 = st.columns([1, 3])
-                with col1:
-                    if selected_post_data["image_url"]:
-                        # Attempt to display the image
-                        try:
-                            st.image(selected_post_data["image_url"], use_column_width=True)
-                        except:
-                            # If there's any format issue, show the raw URL
-                            st.write("Unable to display the image. Here's the URL:")
-                            st.write(selected_post_data["image_url"])
-                    else:
-                        st.write("No image available.")
-
-                with col2:
-                    st.write(f"**Caption:** {selected_post_data['caption']}")
-                    st.write(f"**Date:** {selected_post_data['taken_at']}")
-                    st.write(f"**Likes:** {selected_post_data['like_count']} | **Comments:** {selected_post_data['comment_count']}")
-
-            # Button to generate a similar-style post
-            if st.button("Generate Post In Similar Style"):
-                with st.spinner("Generating a new post in the same style..."):
-                    ai_generated = generate_post_in_same_style(selected_post_data["caption"])
-                st.success("AI-Generated Post")
-                st.write(ai_generated)
-        else:
-            st.warning("No post selected yet.")
+        post_selector()
     else:
         st.write("No posts loaded. Use the sidebar to fetch posts.")
 